@@ -1,42 +1,48 @@
-from datetime import datetime, date, timedelta
-
+import logging
+import sqlite3
+import threading
+from datetime import date, timedelta
+from functools import lru_cache
+
+import altair as alt
+import numpy as np
 import pandas as pd
 import streamlit as st
-import matplotlib.pyplot as plt
-import matplotlib.dates as mdates
-import requests
+import httpx
 
-from supabase import create_client
+from supabase import create_client, ClientOptions
 
 # -----------------------
 # Config / Constants
 # -----------------------
 EMOTIONS = ["嬉しい", "安心", "怒り", "不安", "悲しい", "疲れ", "焦り", "ワクワク", "無感情", "その他"]
 
+logger = logging.getLogger(__name__)
+
 # 熊本大学（黒髪キャンパス付近）を固定
 KUMAMOTO_LAT = 32.825
 KUMAMOTO_LON = 130.739
 
-st.set_page_config(page_title="MindTrace", page_icon="🧠", layout="wide")
+# Open-Meteo archive は数日遅れでデータが入る（これより新しい日付はまだ取れない）
+ARCHIVE_LAG_DAYS = 5
+
+# 過去日の天気は変わらないので、取得済みの分はディスクにも残す（再起動後も API を叩かない）
+WEATHER_CACHE_PATH = ".omcache.sqlite"
 
 # ---- UI: max width / spacing ----
-st.markdown("""
+CSS = """
 <style>
 /* 画面中央に読みやすい幅で集約 */
 .block-container {max-width: 1200px; margin: auto; padding-top: 2.0rem; padding-bottom: 2.0rem;}
 /* 見出しの詰まりを少し改善 */
 h1, h2, h3 {letter-spacing: -0.02em;}
-/* カード風（フォーム・右上サマリ） */
-.card {
-  background: rgba(255,255,255,0.85);
-  border: 1px solid rgba(229,231,235,0.9);
-  border-radius: 16px;
-  padding: 16px;
-  box-shadow: 0 8px 24px rgba(17,24,39,0.06);
-}
-.small {color: #6b7280; font-size: 0.9rem;}
 </style>
-""", unsafe_allow_html=True)
+"""
+
+st.set_page_config(page_title="MindTrace", page_icon="🧠", layout="wide")
+
+# markdown として解釈させず、<style> だけを直接渡す（色・フォントは .streamlit/config.toml の theme）
+st.html(CSS)
 
 # -----------------------
 # Supabase
@@ -46,39 +52,122 @@ def get_supabase():
     cfg = st.secrets["connections"]["supabase"]
     supabase_url = cfg["SUPABASE_URL"]
     supabase_key = cfg["SUPABASE_KEY"]
-    return create_client(supabase_url, supabase_key)
+    # 1つの httpx.Client を使い回して TCP/TLS 接続を再利用（毎回のハンドシェイクを避ける）
+    # postgrest 側が base_url / headers を書き換えるので、この client は Supabase 専用（他の API に流用しない）
+    # 渡した client はそのまま使われるので、postgrest の既定（timeout 120秒・リダイレクト追従）をここで指定する
+    http_client = httpx.Client(
+        http2=True,
+        timeout=httpx.Timeout(120),
+        follow_redirects=True,
+        limits=httpx.Limits(max_keepalive_connections=20, keepalive_expiry=30),
+    )
+    options = ClientOptions(httpx_client=http_client)
+    return create_client(supabase_url, supabase_key, options=options)
 
 supabase = get_supabase()
 
 # -----------------------
 # Web API: Open-Meteo (archive)
 # -----------------------
-@st.cache_data(ttl=60 * 60 * 24)  # 1日キャッシュ（同じ日付を何度も叩かない）
-def fetch_kumamoto_weather_daily(target_date: date):
+NO_WEATHER = {"weather_code": None, "temp_max": None, "temp_min": None}
+
+@st.cache_resource
+def get_http_client():
+    # Open-Meteo 用。接続を使い回して毎回の TLS ハンドシェイクを避ける
+    return httpx.Client(timeout=10, http2=True)
+
+@st.cache_resource
+def get_weather_cache():
+    """天気キャッシュ用の SQLite 接続（プロセスで1つ）。スレッド間で共有するのでロックと組で返す"""
+    conn = sqlite3.connect(WEATHER_CACHE_PATH, check_same_thread=False, isolation_level=None)
+    conn.executescript(
+        "PRAGMA journal_mode=WAL;"
+        "PRAGMA synchronous=NORMAL;"
+        "PRAGMA temp_store=MEMORY;"
+        "CREATE TABLE IF NOT EXISTS weather ("
+        "lat REAL, lon REAL, day TEXT, weather_code INTEGER, temp_max REAL, temp_min REAL, "
+        "PRIMARY KEY (lat, lon, day));"
+    )
+    return conn, threading.Lock()
+
+def _weather_cache_get(start_date: date, end_date: date) -> dict:
+    conn, lock = get_weather_cache()
+    with lock:
+        rows = conn.execute(
+            "SELECT day, weather_code, temp_max, temp_min FROM weather "
+            "WHERE lat = ? AND lon = ? AND day BETWEEN ? AND ?",
+            (KUMAMOTO_LAT, KUMAMOTO_LON, start_date.isoformat(), end_date.isoformat()),
+        ).fetchall()
+    return {
+        date.fromisoformat(day): {"weather_code": code, "temp_max": tmax, "temp_min": tmin}
+        for day, code, tmax, tmin in rows
+    }
+
+def _weather_cache_put(weather: dict):
+    # 確定した過去日だけ保存（今日・直近でまだ値がない日は次回また取りに行く）
+    today = date.today()
+    rows = [
+        (KUMAMOTO_LAT, KUMAMOTO_LON, d.isoformat(), w["weather_code"], w["temp_max"], w["temp_min"])
+        for d, w in weather.items()
+        if d < today and w["weather_code"] is not None
+    ]
+    if not rows:
+        return
+    conn, lock = get_weather_cache()
+    with lock:
+        conn.executemany("INSERT OR REPLACE INTO weather VALUES (?, ?, ?, ?, ?, ?)", rows)
+
+def archive_last_date() -> date:
+    """archive API で天気が取れる最新の日付"""
+    return date.today() - timedelta(days=ARCHIVE_LAG_DAYS)
+
+def fetch_kumamoto_weather_range(start_date: date, end_date: date) -> dict:
     """
-    熊本（固定）の指定日の天気・気温を取得（過去日付OK）
+    熊本（固定）の期間内の天気・気温を1リクエストでまとめて取得（過去日付OK）
     Open-Meteo archive API: キー不要
+    archive にまだない直近の日付は範囲から外す（戻り値にも含めない）
+    キャッシュは確定した日だけを持つディスクキャッシュのみ（欠けた日を含む結果はメモリにも残さない）
+    戻り値: {date: {"weather_code", "temp_max", "temp_min"}}
     """
+    end_date = min(end_date, archive_last_date())
+    if start_date > end_date:
+        return {}
+
+    cached = _weather_cache_get(start_date, end_date)
+    if len(cached) == (end_date - start_date).days + 1:
+        return cached
+
     url = "https://archive-api.open-meteo.com/v1/archive"
     params = {
         "latitude": KUMAMOTO_LAT,
         "longitude": KUMAMOTO_LON,
-        "start_date": target_date.isoformat(),
-        "end_date": target_date.isoformat(),
+        "start_date": start_date.isoformat(),
+        "end_date": end_date.isoformat(),
         "daily": ["weather_code", "temperature_2m_max", "temperature_2m_min"],
         "timezone": "Asia/Tokyo",
     }
-    r = requests.get(url, params=params, timeout=10)
+    r = get_http_client().get(url, params=params)
     r.raise_for_status()
     data = r.json()
     daily = data.get("daily", {})
 
-    return {
-        "weather_code": (daily.get("weather_code") or [None])[0],
-        "temp_max": (daily.get("temperature_2m_max") or [None])[0],
-        "temp_min": (daily.get("temperature_2m_min") or [None])[0],
+    weather = {
+        date.fromisoformat(t): {"weather_code": code, "temp_max": tmax, "temp_min": tmin}
+        for t, code, tmax, tmin in zip(
+            daily.get("time") or [],
+            daily.get("weather_code") or [],
+            daily.get("temperature_2m_max") or [],
+            daily.get("temperature_2m_min") or [],
+        )
     }
+    _weather_cache_put(weather)
+    return weather
+
+def fetch_kumamoto_weather_daily(target_date: date):
+    """熊本（固定）の指定日の天気・気温（期間取得の1日版）"""
+    return fetch_kumamoto_weather_range(target_date, target_date).get(target_date, NO_WEATHER)
 
+@lru_cache(maxsize=128)  # コードは高々100種類なので結果を覚えておく
 def weather_group(code):
     """Open-Meteo weather_code をざっくりカテゴリ化（分析用）"""
     if code is None:
@@ -102,18 +191,44 @@ def weather_group(code):
         return "雷"
     return "その他"
 
+# weather_code（0〜99）→ カテゴリの対応表。列全体は weather_group_vec で一括変換する
+WGROUP = np.full(100, "その他", dtype=object)
+WGROUP[0] = "晴れ"
+WGROUP[1:4] = "くもり"
+WGROUP[[45, 48]] = "霧"
+WGROUP[51:68] = "雨"
+WGROUP[80:83] = "雨"
+WGROUP[71:78] = "雪"
+WGROUP[85:87] = "雪"
+WGROUP[95:100] = "雷"
+
+def weather_group_vec(codes: pd.Series) -> np.ndarray:
+    """weather_group の列版（行ごとの .apply をやめて配列の添字参照1回で分類）"""
+    num = pd.to_numeric(codes, errors="coerce")
+    c = num.fillna(-1).astype(int).to_numpy()
+    out = np.full(len(c), "その他", dtype=object)
+    in_range = (c >= 0) & (c <= 99)
+    out[in_range] = WGROUP[c[in_range]]
+    out[num.isna().to_numpy()] = "不明"
+    return out
+
 # -----------------------
 # DB helpers
 # -----------------------
-def insert_entry(entry_date, event, emotion, intensity, interpretation, desire, next_action):
-    # Web API で天気を取得（失敗しても日記は保存できるようにする）
+def _fill_weather(entry_id: int, entry_date: date):
+    """保存済みの1件に熊本の天気を後から書き込む（バックグラウンドスレッドで実行）"""
+    # 失敗しても日記は保存済みなので、ログだけ残して終える
     try:
         w = fetch_kumamoto_weather_daily(entry_date)
+        if w["weather_code"] is None:
+            return
+        supabase.table("entries").update(w).eq("id", int(entry_id)).execute()
+        clear_entry_caches()
     except Exception:
-        w = {"weather_code": None, "temp_max": None, "temp_min": None}
+        logger.exception("天気の後埋めに失敗しました（id=%s, entry_date=%s）", entry_id, entry_date)
 
+def insert_entry(entry_date, event, emotion, intensity, interpretation, desire, next_action):
     payload = {
-        "created_at": datetime.now().isoformat(timespec="seconds"),
         "entry_date": entry_date.isoformat(),
         "event": event.strip(),
         "emotion": emotion,
@@ -121,28 +236,186 @@ def insert_entry(entry_date, event, emotion, intensity, interpretation, desire,
         "interpretation": (interpretation or "").strip(),
         "desire": (desire or "").strip(),
         "next_action": (next_action or "").strip(),
-        # ---- 外部WebAPI（熊本の天気） ----
-        "weather_code": w["weather_code"],
-        "temp_max": w["temp_max"],
-        "temp_min": w["temp_min"],
     }
-    return supabase.table("entries").insert(payload).execute()
+    res = supabase.table("entries").insert(payload).execute()
+
+    # 天気（外部WebAPI）は保存を待たせずに後から埋める
+    # archive にまだない直近の日付（今日など）はスレッドを立てず、定期の backfill_weather に任せる
+    if res.data and entry_date <= archive_last_date():
+        threading.Thread(target=_fill_weather, args=(res.data[0]["id"], entry_date), daemon=True).start()
+    return res
+
+def insert_entries(rows: list[dict], batch_size: int = 500):
+    """まとめて登録（インポート用）。batch_size 件ごとに1回の multi-row INSERT にする"""
+    results = [
+        supabase.table("entries").insert(rows[i:i + batch_size]).execute()
+        for i in range(0, len(rows), batch_size)
+    ]
+    clear_entry_caches()
+    return results
+
+def backfill_weather(page_size: int = 1000) -> int:
+    """
+    天気が未保存（weather_code IS NULL）の過去の記録に、あとから天気を埋める
+    対象の日付範囲を Open-Meteo に1回だけ問い合わせ、日付ごとにまとめて update する
+    （archive API にまだない直近 ARCHIVE_LAG_DAYS 日分は対象外。日が経ってからの実行で埋まる）
+    """
+    # PostgREST は1回の応答行数に上限（既定 1000）があるので、page_size ずつ全件たどる
+    ids_by_date = {}
+    start = 0
+    while True:
+        res = (
+            supabase.table("entries")
+            .select("id, entry_date")
+            .is_("weather_code", "null")
+            .lte("entry_date", archive_last_date().isoformat())
+            .order("id")
+            .range(start, start + page_size - 1)
+            .execute()
+        )
+        rows = res.data or []
+        for r in rows:
+            ids_by_date.setdefault(date.fromisoformat(r["entry_date"]), []).append(r["id"])
+        if len(rows) < page_size:
+            break
+        start += page_size
+    if not ids_by_date:
+        return 0
+
+    weather = fetch_kumamoto_weather_range(min(ids_by_date), max(ids_by_date))
+    updated = 0
+    for d, ids in ids_by_date.items():
+        w = weather.get(d)
+        if not w or w["weather_code"] is None:
+            continue
+        supabase.table("entries").update(w).in_("id", ids).execute()
+        updated += len(ids)
+
+    if updated:
+        clear_entry_caches()
+    return updated
+
+def _backfill_weather_in_background():
+    try:
+        n = backfill_weather()
+        if n:
+            logger.info("天気を後埋めしました（%d 件）", n)
+    except Exception:
+        logger.exception("天気の後埋めに失敗しました")
+
+@st.cache_resource(ttl=60 * 60, show_spinner=False)  # プロセスごとに1時間に1回だけ
+def start_weather_backfill():
+    """起動時（と以後1時間ごと）に、天気が欠けた記録の後埋めをバックグラウンドで走らせる"""
+    t = threading.Thread(target=_backfill_weather_in_background, daemon=True)
+    t.start()
+    return t
 
 def delete_entry(entry_id: int):
     return supabase.table("entries").delete().eq("id", int(entry_id)).execute()
 
-def load_entries(days=30) -> pd.DataFrame:
+@st.cache_data(ttl=60, show_spinner=False)  # 再実行ごとに Supabase を叩かない（保存・削除時は clear）
+def load_entries_summary(days: int = 30) -> pd.DataFrame:
+    """一覧・ダッシュボード・可視化用。長文の列（解釈・欲求など）は取らない"""
     since = (date.today() - timedelta(days=days)).isoformat()
     res = (
         supabase.table("entries")
-        .select("id, created_at, entry_date, event, emotion, intensity, interpretation, desire, next_action, weather_code, temp_max, temp_min")
+        .select("id, entry_date, emotion, intensity, event, weather_code, temp_max, temp_min")
         .gte("entry_date", since)
         .order("entry_date", desc=True)
         .order("id", desc=True)
         .execute()
     )
     data = res.data or []
-    return pd.DataFrame(data)
+    df = pd.DataFrame(data)
+    if df.empty:
+        return df
+
+    # 型変換はここで1回だけ（各ヘルパーでは to_datetime / to_numeric しない）
+    df["entry_date"] = pd.to_datetime(df["entry_date"], errors="coerce")
+    df["intensity"] = pd.to_numeric(df["intensity"], errors="coerce", downcast="integer")
+    df["event"] = df["event"].astype("string[pyarrow]")
+    # 感情は固定のカテゴリなので Categorical（一覧にない古い値もカテゴリに残す）
+    extra = sorted(set(df["emotion"].dropna()) - set(EMOTIONS))
+    df["emotion"] = pd.Categorical(df["emotion"], categories=EMOTIONS + extra)
+    return df
+
+@st.cache_data(ttl=60, show_spinner=False)
+def load_entry_detail(entry_id: int) -> dict | None:
+    """思考フロー表示用に1件だけ全項目を取得（別タブなどで削除済みなら None）"""
+    res = (
+        supabase.table("entries")
+        .select("id, entry_date, event, emotion, intensity, interpretation, desire, next_action, weather_code, temp_max, temp_min")
+        .eq("id", int(entry_id))
+        .maybe_single()
+        .execute()
+    )
+    # 該当なしのとき maybe_single は None を返す
+    return res.data if res is not None else None
+
+@st.cache_data(ttl=60, show_spinner=False)
+def weekly_review(days: int = 7):
+    """直近 days 日のサマリを Postgres 側で集計（RPC: weekly_review）して1行だけ受け取る"""
+    since = date.today() - timedelta(days=days - 1)
+    res = supabase.rpc("weekly_review", {"since": since.isoformat()}).execute()
+    r = (res.data or [{}])[0]
+    num_records = int(r.get("num_records") or 0)
+    return {
+        "since": since, "days": days, "num_records": num_records,
+        "num_days": int(r.get("num_days") or 0),
+        "top_emotion": r.get("top_emotion"),
+        "avg_intensity": r.get("avg_intensity") if num_records else None,
+    }
+
+@st.cache_data(ttl=60, show_spinner=False)
+def load_emotion_counts(days: int = 30) -> pd.Series:
+    """感情カテゴリ別の件数を Postgres 側で集計（RPC: emotion_counts）。並び順はグラフ側で決める"""
+    since = (date.today() - timedelta(days=days)).isoformat()
+    res = supabase.rpc("emotion_counts", {"since": since}).execute()
+    data = res.data or []
+    return pd.Series([r["n"] for r in data], index=[r["emotion"] for r in data], dtype="int64")
+
+@st.cache_data(ttl=60, show_spinner=False)
+def load_daily_intensity(days: int = 30) -> pd.DataFrame:
+    """強度の推移を Postgres 側で日平均（30日超は週平均）にして取得（RPC: daily_intensity）。日付の昇順"""
+    since = (date.today() - timedelta(days=days)).isoformat()
+    res = supabase.rpc("daily_intensity", {"since": since, "weekly": days > 30}).execute()
+    d = pd.DataFrame(res.data or [], columns=["entry_date", "avg_intensity", "n"])
+    d["entry_date"] = pd.to_datetime(d["entry_date"])
+    return d
+
+@st.cache_data(ttl=60, show_spinner=False)
+def load_next_actions(days: int = 30, max_items: int = 8) -> pd.DataFrame:
+    """「次の行動」が書かれた記録だけを新しい順に max_items 件、Postgres 側で絞って取得"""
+    since = (date.today() - timedelta(days=days)).isoformat()
+    res = (
+        supabase.table("entries")
+        .select("next_action, entry_date, emotion, intensity")
+        .gte("entry_date", since)
+        .not_.is_("next_action", "null")
+        .neq("next_action", "")
+        .order("entry_date", desc=True)
+        .order("id", desc=True)
+        .limit(max_items)
+        .execute()
+    )
+    return pd.DataFrame(res.data or [])
+
+def clear_entry_caches():
+    """保存・削除のあとに、entries 由来のキャッシュをまとめて捨てる"""
+    load_entries_summary.clear()
+    load_entry_detail.clear()
+    weekly_review.clear()
+    load_emotion_counts.clear()
+    load_daily_intensity.clear()
+    load_next_actions.clear()
+    prepare_viz.clear()
+
+def filter_days(df: pd.DataFrame, days: int) -> pd.DataFrame:
+    """取得済みの df を直近 days 日に絞る（再取得しない）"""
+    if df.empty:
+        return df
+    since = pd.Timestamp(date.today() - timedelta(days=days))
+    return df[df["entry_date"] >= since]
 
 # -----------------------
 # View helpers
@@ -157,220 +430,116 @@ def flow_text(row: dict) -> str:
     ]
     return "\n↓\n".join([p for p in parts if p.split("：", 1)[1].strip()])
 
-def plot_intensity(df: pd.DataFrame):
-    if df.empty:
-        st.info("まだデータがありません。まず1件記録してみてください。")
-        return
-
-    d = df.copy()
-    d["entry_date"] = pd.to_datetime(d["entry_date"], errors="coerce")
-    d["intensity"] = pd.to_numeric(d["intensity"], errors="coerce")
-    d = d.dropna(subset=["entry_date", "intensity"]).sort_values("entry_date")
-
+def plot_intensity(d: pd.DataFrame):
+    """d: load_daily_intensity の結果（entry_date 昇順・欠損なし）"""
     if d.empty:
-        st.info("可視化できるデータがありません（日付/強度が欠損）。")
+        st.info("まだデータがありません。まず1件記録してみてください。")
         return
 
-    fig, ax = plt.subplots()
-    ax.plot(d["entry_date"], d["intensity"], marker="o")
-    ax.set_ylim(0, 10)
-    ax.set_xlabel("date")
-    ax.set_ylabel("intensity (0-10)")
-
-    # 直近 days に合わせてズーム（表示データの範囲が狭いと見やすい）
-    start = d["entry_date"].min() - pd.Timedelta(days=1)
-    end = d["entry_date"].max() + pd.Timedelta(days=1)
-    ax.set_xlim(start, end)
-
-    ax.xaxis.set_major_locator(mdates.DayLocator(interval=7))
-    ax.xaxis.set_major_formatter(mdates.DateFormatter("%m/%d"))
-    fig.autofmt_xdate()
-
-    ax.axhline(5, linewidth=1, linestyle="--")
-    st.pyplot(fig)
+    # Vega-Lite でブラウザ側に描画（サーバで PNG を作らない）。縦軸は 0〜10 固定、5 に基準線
+    line = alt.Chart(d).mark_line(point=True).encode(
+        x=alt.X("entry_date:T", title="date", axis=alt.Axis(format="%m/%d")),
+        y=alt.Y("avg_intensity:Q", title="avg intensity (0-10)", scale=alt.Scale(domain=[0, 10])),
+    )
+    rule = alt.Chart(pd.DataFrame({"y": [5]})).mark_rule(strokeDash=[4, 4]).encode(y="y:Q")
+    st.altair_chart((line + rule).properties(height=300), width="stretch")
 
-def plot_emotion_counts(df: pd.DataFrame):
-    if df.empty:
+def plot_emotion_counts(counts: pd.Series):
+    """counts: 感情 → 件数（load_emotion_counts の結果）"""
+    if counts.empty:
         st.info("まだデータがありません。まず1件記録してみてください。")
         return
 
-    d = df.copy()
-    d["emotion"] = d["emotion"].fillna("不明").astype(str)
-    counts = d["emotion"].value_counts().sort_values(ascending=True)
+    d = counts.rename_axis("emotion").reset_index(name="count")
+    # 件数の多い順に上から並べる（st.bar_chart はラベル順になるので Altair で sort を指定）
+    bars = alt.Chart(d).mark_bar().encode(
+        x=alt.X("count:Q", title="count"),
+        y=alt.Y("emotion:N", title="emotion", sort="-x"),
+    )
+    text = bars.mark_text(align="left", dx=3).encode(text="count:Q")
+    st.altair_chart((bars + text).properties(height=300), width="stretch")
 
-    fig, ax = plt.subplots()
-    ax.barh(counts.index, counts.values)
-    ax.set_xlabel("count")
+def _df_fingerprint(df: pd.DataFrame) -> tuple:
+    """キャッシュキー用の（件数, 最大ID）。追加・削除はこれで検出できるが行の中身は見ないので、
+    行の更新はこのプロセス内なら clear_entry_caches、プロセス外（SQL Editor など）ならキャッシュの ttl で反映する"""
+    return (len(df), int(df["id"].max()) if not df.empty else 0)
 
-    for i, v in enumerate(counts.values):
-        ax.text(v + 0.02, i, str(int(v)), va="center")
+@st.cache_data(ttl=60, show_spinner=False, hash_funcs={pd.DataFrame: _df_fingerprint})
+def prepare_viz(df: pd.DataFrame) -> dict:
+    """
+    天気まわりのグラフ用データを1回でまとめて作る（列の変換・集計を各グラフで繰り返さない）
+    戻り値: {"by_weather": 天気カテゴリ別の平均強度, "temp_points": 平均気温 × 強度}
+    """
+    if df.empty:
+        return {"by_weather": pd.Series(dtype="float64"), "temp_points": pd.DataFrame(columns=["temp_mean", "intensity"])}
 
-    st.pyplot(fig)
+    inten = df["intensity"]
+    temp_mean = (pd.to_numeric(df["temp_max"], errors="coerce") + pd.to_numeric(df["temp_min"], errors="coerce")) / 2
+    has_inten = inten.notna()
 
-def plot_intensity_by_weather(df: pd.DataFrame):
-    if df.empty or "weather_code" not in df.columns:
-        st.caption("天気データがありません。")
-        return
+    groups = weather_group_vec(df.loc[has_inten, "weather_code"])
+    by_weather = inten[has_inten].groupby(groups).mean()
 
-    d = df.copy()
-    d["intensity"] = pd.to_numeric(d["intensity"], errors="coerce")
-    d["weather_group"] = d["weather_code"].apply(weather_group)
-    d = d.dropna(subset=["intensity"])
+    has_temp = has_inten & temp_mean.notna()
+    temp_points = pd.DataFrame({"temp_mean": temp_mean[has_temp], "intensity": inten[has_temp]})
+    return {"by_weather": by_weather, "temp_points": temp_points}
 
-    if d.empty:
+def plot_intensity_by_weather(agg: pd.Series):
+    """agg: 天気カテゴリ → 平均強度（prepare_viz の by_weather）"""
+    if agg.empty:
         st.caption("分析できるデータがありません。")
         return
 
-    agg = d.groupby("weather_group")["intensity"].mean().sort_values(ascending=False)
-
-    fig, ax = plt.subplots()
-    ax.bar(agg.index.astype(str), agg.values)
-    ax.set_ylim(0, 10)
-    ax.set_ylabel("avg intensity (0-10)")
-    ax.set_xlabel("weather (Kumamoto)")
-    plt.xticks(rotation=30, ha="right")
-    st.pyplot(fig)
-
-def plot_temp_vs_intensity(df: pd.DataFrame):
-    if df.empty or ("temp_max" not in df.columns) or ("temp_min" not in df.columns):
-        st.caption("気温データがありません。")
-        return
-
-    d = df.copy()
-    d["intensity"] = pd.to_numeric(d["intensity"], errors="coerce")
-    d["temp_max"] = pd.to_numeric(d["temp_max"], errors="coerce")
-    d["temp_min"] = pd.to_numeric(d["temp_min"], errors="coerce")
-    d["temp_mean"] = (d["temp_max"] + d["temp_min"]) / 2
-    d = d.dropna(subset=["temp_mean", "intensity"])
+    d = agg.rename_axis("weather").reset_index(name="avg_intensity")
+    # 平均強度の高い順に並べる
+    chart = alt.Chart(d).mark_bar().encode(
+        x=alt.X("weather:N", title="weather (Kumamoto)", sort="-y", axis=alt.Axis(labelAngle=-30)),
+        y=alt.Y("avg_intensity:Q", title="avg intensity (0-10)", scale=alt.Scale(domain=[0, 10])),
+    )
+    st.altair_chart(chart.properties(height=300), width="stretch")
 
-    if d.empty:
+def plot_temp_vs_intensity(points: pd.DataFrame):
+    """points: temp_mean / intensity の2列（prepare_viz の temp_points）"""
+    if points.empty:
         st.caption("分析できるデータがありません。")
         return
 
-    fig, ax = plt.subplots()
-    ax.scatter(d["temp_mean"], d["intensity"])
-    ax.set_xlabel("mean temp (°C) in Kumamoto")
-    ax.set_ylabel("intensity (0-10)")
-    ax.set_ylim(0, 10)
-    st.pyplot(fig)
-
-def weekly_review(df: pd.DataFrame, days: int = 7):
-    if df.empty:
-        return None
-    d = df.copy()
-    d["entry_date"] = pd.to_datetime(d["entry_date"]).dt.date
-    since = date.today() - timedelta(days=days - 1)
-    w = d[d["entry_date"] >= since]
-    if w.empty:
-        return {
-            "since": since, "days": days, "num_records": 0, "num_days": 0,
-            "top_emotion": None, "avg_intensity": None
-        }
-    num_days = int(pd.Series(w["entry_date"]).nunique())
-    top_emotion = w["emotion"].value_counts().idxmax()
-    avg_intensity = float(pd.to_numeric(w["intensity"], errors="coerce").dropna().mean())
-    return {
-        "since": since, "days": days, "num_days": num_days,
-        "top_emotion": top_emotion, "avg_intensity": avg_intensity
-    }
-
-def next_action_list(df: pd.DataFrame, max_items: int = 8) -> pd.DataFrame:
-    if df.empty:
-        return pd.DataFrame()
-    d = df.copy()
-    d["next_action"] = d["next_action"].fillna("").astype(str).str.strip()
-    d = d[d["next_action"] != ""]
-    if d.empty:
-        return pd.DataFrame()
-    return d.head(max_items)
+    st.scatter_chart(points, x="temp_mean", y="intensity", x_label="mean temp (°C) in Kumamoto", y_label="intensity (0-10)", height=300)
 
 # -----------------------
-# App
+# App sections（st.fragment: 操作した部分だけ再実行）
 # -----------------------
-st.title("🧠 MindTrace ")
-st.caption("出来事 → 感情 → 解釈 → 欲求 → 次の行動 を1分で整理")
-
-df = load_entries(days=30)
-
-left, right = st.columns([1.05, 0.95], gap="large")
-
-with left:
+@st.fragment  # フォーム操作ではこの部分だけ再実行（保存成功時は st.rerun でアプリ全体を更新）
+def _entry_form():
     st.markdown("## ✍️ 今日の記録")
 
-    st.markdown('<div class="card">', unsafe_allow_html=True)
-    with st.form("entry_form", clear_on_submit=True):
-        entry_date = st.date_input("日付", value=date.today())
-        event = st.text_area("出来事（何があった？）", height=110, placeholder="例：課題が終わらなくて焦った")
-        emotion = st.selectbox("感情（何を感じた？）", EMOTIONS, index=5 if "疲れ" in EMOTIONS else 0)
-        intensity = st.slider("感情の強度（0〜10）", 0, 10, 6)
-        interpretation = st.text_area("解釈（どういう意味だと思った？）", height=80, placeholder="例：準備不足で詰んだ気がする")
-        desire = st.text_area("欲求（本当はどうしたい？）", height=80, placeholder="例：余裕を持って終わらせたい")
-        next_action = st.text_input("次の行動（小さく具体的に）", placeholder="例：今日19:00〜19:30で課題の最初の1問だけやる")
-        submitted = st.form_submit_button("保存")
-
-    if submitted:
-        if not event.strip():
-            st.error("出来事は必須です。")
-        else:
-            res = insert_entry(entry_date, event, emotion, intensity, interpretation, desire, next_action)
-            if getattr(res, "error", None):
-                st.error(f"保存に失敗: {res.error}")
+    with st.container(border=True):
+        with st.form("entry_form", clear_on_submit=True, border=False):
+            entry_date = st.date_input("日付", value=date.today())
+            event = st.text_area("出来事（何があった？）", height=110, placeholder="例：課題が終わらなくて焦った")
+            emotion = st.selectbox("感情（何を感じた？）", EMOTIONS, index=5 if "疲れ" in EMOTIONS else 0)
+            intensity = st.slider("感情の強度（0〜10）", 0, 10, 6)
+            interpretation = st.text_area("解釈（どういう意味だと思った？）", height=80, placeholder="例：準備不足で詰んだ気がする")
+            desire = st.text_area("欲求（本当はどうしたい？）", height=80, placeholder="例：余裕を持って終わらせたい")
+            next_action = st.text_input("次の行動（小さく具体的に）", placeholder="例：今日19:00〜19:30で課題の最初の1問だけやる")
+            submitted = st.form_submit_button("保存")
+
+        if submitted:
+            if not event.strip():
+                st.error("出来事は必須です。")
             else:
-                st.success("保存しました。（熊本の天気も一緒に保存されます）")
-                st.rerun()
-    st.markdown("</div>", unsafe_allow_html=True)
-
-with right:
-    st.markdown("## 📌 ダッシュボード")
-
-    st.markdown('<div class="card">', unsafe_allow_html=True)
-    st.markdown("### 📅 今週のふりかえり（7日）")
-    summary = weekly_review(df, days=7)
-    if summary and summary["num_days"] > 0:
-        c1, c2, c3 = st.columns(3)
-        c1.metric("記録日数", f"{summary['num_days']}日")
-        c2.metric("最多の感情", summary["top_emotion"])
-        c3.metric("平均強度", f"{summary['avg_intensity']:.1f}/10")
-        st.markdown(f"<div class='small'>対象：直近7日</div>", unsafe_allow_html=True)
-    else:
-        st.caption("直近7日分の記録がまだありません。記録するとここにサマリが表示されます。")
-
-    st.markdown("---")
-
-    st.markdown("### ▶ 次の行動リスト")
-    na = next_action_list(df, max_items=8)
-    if na is None or na.empty:
-        st.caption("まだ「次の行動」が書かれた記録がありません。左の入力で書くとここに集まります。")
-    else:
-        for _, r in na.iterrows():
-            action = str(r.get("next_action", "")).strip()
-            if not action:
-                continue
-            d0 = r.get("entry_date", "")
-            emo = r.get("emotion", "")
-            inten = r.get("intensity", "")
-            st.markdown(f"- **{action}**  \n  <span class='small'>{d0} / {emo}（{inten}/10）</span>", unsafe_allow_html=True)
-
-    st.markdown("</div>", unsafe_allow_html=True)
-
-    st.markdown("## 📚 最近の記録（30日）")
-    if df.empty:
-        st.info("まだ記録がありません。左から1件保存すると表示されます。")
-    else:
-        show_df = df[["id", "entry_date", "emotion", "intensity", "event"]].copy()
-        show_df.rename(columns={"entry_date": "日付", "emotion": "感情", "intensity": "強度", "event": "出来事"}, inplace=True)
-        st.dataframe(show_df, use_container_width=True, height=260)
-
-st.markdown("## 🔎 詳細")
+                res = insert_entry(entry_date, event, emotion, intensity, interpretation, desire, next_action)
+                if getattr(res, "error", None):
+                    st.error(f"保存に失敗: {res.error}")
+                else:
+                    st.success("保存しました。（熊本の天気は取得できしだい自動で追加されます）")
+                    clear_entry_caches()
+                    st.rerun()
 
-if df.empty:
-    st.caption("記録を追加すると、詳細表示と可視化が使えます。")
-else:
-    ids = df["id"].tolist()
+@st.fragment  # ID の選択・削除チェックではこの部分だけ再実行
+def _detail_pane(ids: list):
     selected_id = st.selectbox("表示するIDを選択", ids, index=0)
 
-    row = df[df["id"] == selected_id].iloc[0].to_dict()
-
     with st.expander("🧠 思考フロー（1件表示）", expanded=True):
         col_a, col_b = st.columns([1, 5])
         with col_a:
@@ -382,8 +551,14 @@ else:
                     st.error(f"削除に失敗: {del_res.error}")
                 else:
                     st.success(f"ID {selected_id} を削除しました。")
+                    clear_entry_caches()
                     st.rerun()
 
+        row = load_entry_detail(selected_id)
+        if not row:
+            st.caption(f"ID {selected_id} の記録は見つかりませんでした（すでに削除された可能性があります）。")
+            return
+
         # 天気表示（保存されていれば）
         wc = row.get("weather_code")
         tmin = row.get("temp_min")
@@ -392,18 +567,22 @@ else:
 
         st.text(flow_text(row))
 
+@st.fragment  # 表示期間の切り替えではグラフ部分だけ再実行
+def _charts_pane():
     with st.expander("📊 可視化・分析（期間別）", expanded=False):
-        days = st.selectbox("表示期間", [7, 14, 30, 60, 90], index=2)
-        df_viz = load_entries(days=days)
+        days = st.selectbox("表示期間", [7, 14, 30, 60, 90], index=2, key="viz_days")
+        # フラグメント単体の再実行でも期間が広がったら取り直せるよう、ここで（キャッシュ経由で）取得する
+        df_viz = filter_days(load_entries_summary(days=max(days, 30)), days)
+        viz = prepare_viz(df_viz)
 
         st.caption("推移と分布")
         c1, c2 = st.columns(2)
         with c1:
             st.caption("感情強度の推移")
-            plot_intensity(df_viz)
+            plot_intensity(load_daily_intensity(days))
         with c2:
             st.caption("感情カテゴリの回数")
-            plot_emotion_counts(df_viz)
+            plot_emotion_counts(load_emotion_counts(days))
 
         st.divider()
 
@@ -411,10 +590,76 @@ else:
         c3, c4 = st.columns(2)
         with c3:
             st.caption("天気カテゴリ別：平均強度")
-            plot_intensity_by_weather(df_viz)
+            plot_intensity_by_weather(viz["by_weather"])
         with c4:
             st.caption("平均気温 × 強度（散布図）")
-            plot_temp_vs_intensity(df_viz)
+            plot_temp_vs_intensity(viz["temp_points"])
+
+# -----------------------
+# App
+# -----------------------
+st.title("🧠 MindTrace ")
+st.caption("出来事 → 感情 → 解釈 → 欲求 → 次の行動 を1分で整理")
+
+# 保存時に天気を取れなかった記録（archive にまだない直近の日付・API 失敗など）を後から埋める
+start_weather_backfill()
+
+# 表示期間（可視化）は下の selectbox の値。最も広い期間で1回だけ取得し、各表示はメモリ上で絞り込む
+viz_days = st.session_state.get("viz_days", 30)
+df_all = load_entries_summary(days=max(viz_days, 30))
+df = filter_days(df_all, 30)
+
+left, right = st.columns([1.05, 0.95], gap="large")
+
+with left:
+    _entry_form()
+
+with right:
+    st.markdown("## 📌 ダッシュボード")
+
+    with st.container(border=True):
+        st.markdown("### 📅 今週のふりかえり（7日）")
+        summary = weekly_review(days=7)
+        if summary and summary["num_days"] > 0:
+            c1, c2, c3 = st.columns(3)
+            c1.metric("記録日数", f"{summary['num_days']}日")
+            c2.metric("最多の感情", summary["top_emotion"])
+            c3.metric("平均強度", f"{summary['avg_intensity']:.1f}/10")
+            st.caption("対象：直近7日")
+        else:
+            st.caption("直近7日分の記録がまだありません。記録するとここにサマリが表示されます。")
+
+        st.markdown("---")
+
+        st.markdown("### ▶ 次の行動リスト")
+        na = load_next_actions(days=30, max_items=8)
+        if na is None or na.empty:
+            st.caption("まだ「次の行動」が書かれた記録がありません。左の入力で書くとここに集まります。")
+        else:
+            for action, d0, emo, inten in zip(
+                na["next_action"].to_numpy(), na["entry_date"].to_numpy(),
+                na["emotion"].to_numpy(), na["intensity"].to_numpy(),
+            ):
+                st.markdown(f"- **{action}**  \n  :gray[{d0} / {emo}（{inten}/10）]")
+
+    st.markdown("## 📚 最近の記録（30日）")
+    if df.empty:
+        st.info("まだ記録がありません。左から1件保存すると表示されます。")
+    else:
+        show_df = df[["id", "entry_date", "emotion", "intensity", "event"]].copy()
+        show_df.rename(columns={"entry_date": "日付", "emotion": "感情", "intensity": "強度", "event": "出来事"}, inplace=True)
+        st.dataframe(
+            show_df, width="stretch", height=260,
+            column_config={"日付": st.column_config.DateColumn(format="YYYY-MM-DD")},
+        )
+
+st.markdown("## 🔎 詳細")
+
+if df.empty:
+    st.caption("記録を追加すると、詳細表示と可視化が使えます。")
+else:
+    _detail_pane(df["id"].tolist())
+    _charts_pane()
 
 st.divider()
 st.caption("Supabase（PostgreSQL）に保存することで、アプリが休止してもデータが消えない永続化を実現しています。")
@@ -0,0 +1,29 @@
+-- 今週のふりかえり（記録件数・記録日数・最多の感情・平均強度）を1行で返す
+-- 「今日」はアプリ側（JST）で決めるため、期間の開始日を引数で受け取る
+-- 最多の感情が同数のときは、いちばん新しい記録の感情を選ぶ
+create or replace function public.weekly_review(since date)
+returns table (
+  num_records bigint,
+  num_days bigint,
+  top_emotion text,
+  avg_intensity double precision
+)
+language sql
+stable
+as $$
+  select
+    count(*),
+    count(distinct entry_date),
+    (
+      select t.emotion
+      from public.entries t
+      where t.entry_date >= since
+        and t.emotion is not null
+      group by t.emotion
+      order by count(*) desc, max(t.entry_date) desc, max(t.id) desc
+      limit 1
+    ),
+    avg(intensity)::double precision
+  from public.entries
+  where entry_date >= since;
+$$;
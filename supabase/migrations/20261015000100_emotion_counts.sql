@@ -0,0 +1,14 @@
+-- 感情カテゴリごとの記録数（最大でも EMOTIONS の種類数ぶんの行）
+create or replace function public.emotion_counts(since date)
+returns table (
+  emotion text,
+  n bigint
+)
+language sql
+stable
+as $$
+  select coalesce(emotion, '不明') as emotion, count(*) as n
+  from public.entries
+  where entry_date >= since
+  group by 1;
+$$;
@@ -0,0 +1,20 @@
+-- 感情強度の推移（日ごとの平均）。長い期間では週ごとに平均してから返す
+create or replace function public.daily_intensity(since date, weekly boolean default false)
+returns table (
+  entry_date date,
+  avg_intensity double precision,
+  n bigint
+)
+language sql
+stable
+as $$
+  select
+    case when weekly then date_trunc('week', e.entry_date)::date else e.entry_date end as entry_date,
+    avg(e.intensity)::double precision as avg_intensity,
+    count(*) as n
+  from public.entries e
+  where e.entry_date >= since
+    and e.intensity is not null
+  group by 1
+  order by 1;
+$$;
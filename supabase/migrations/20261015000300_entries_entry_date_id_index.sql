@@ -0,0 +1,4 @@
+-- load_entries_summary の「entry_date >= ? order by entry_date desc, id desc」を
+-- ソートなしのインデックス走査で返せるようにする
+create index if not exists entries_entry_date_id_idx
+  on public.entries (entry_date desc, id desc);
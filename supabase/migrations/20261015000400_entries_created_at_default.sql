@@ -0,0 +1,3 @@
+-- created_at はクライアントから送らず DB 側で付ける
+alter table public.entries
+  alter column created_at set default now();